@@ -171,6 +171,18 @@ class ScriptArguments:
         default=False,
         metadata={"help": "Enables Gradient Checkpointing."},
     )
+    force_fp32_norm: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Casts the norm layers to fp32 even if bf16 training runs on a GPU that supports bf16 (Ampere+)."},
+    )
+    use_torch_compile: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Lets the Trainer compile the model with torch.compile (mode reduce-overhead). Batches are padded to buckets of --pad_to_multiple_of tokens to avoid recompilation."},
+    )
+    pad_to_multiple_of: Optional[int] = field(
+        default=None,
+        metadata={"help": "Pads the batch sequence length up to a multiple of this value. Defaults to 256 with --use_torch_compile so only a few static shapes are compiled, otherwise 8."},
+    )
     dataset_text_field: str = field(
         default="text", metadata={"help": "Dataset field to use as input text."}
     )
@@ -218,6 +230,9 @@ def main(args):
         push_to_hub=args.push_to_hub,
         gradient_checkpointing=args.use_gradient_checkpointing,
         include_tokens_per_second=False,
+        remove_unused_columns=False, # keep the gate_labels column, the collator merges it into labels
+        torch_compile=args.use_torch_compile,
+        torch_compile_mode="reduce-overhead" if args.use_torch_compile else None,
     )
     
     
@@ -271,13 +286,15 @@ def main(args):
             output.requires_grad_(True)
 
     print(training_arguments)
+    # compiled graphs are cached per sequence length, so pad to coarse buckets when compiling
+    pad_to_multiple_of = args.pad_to_multiple_of or (256 if args.use_torch_compile else 8)
     # trainer
     trainer = Trainer(
         model=model,
         args=training_arguments,
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
-        data_collator=partial(collate_dataset, tokenizer=tokenizer),
+        data_collator=partial(collate_dataset_fast, pad_id=tokenizer.pad_token_id, pad_to_multiple_of=pad_to_multiple_of),
     )
     trainer.accelerator.print(f"{trainer.model}")
     if args.use_peft_lora:
@@ -300,10 +317,7 @@ def main(args):
 
     if is_deepspeed_peft_enabled:
         trainer.accelerator.wait_for_everyone()
-        state_dict = trainer.accelerator.get_state_dict(trainer.deepspeed)
-        unwrapped_model = trainer.accelerator.unwrap_model(trainer.deepspeed)
-        if trainer.accelerator.is_main_process:
-            unwrapped_model.save_pretrained(args.output_dir, state_dict=state_dict)
+        save_deepspeed_peft_model(trainer, args.output_dir)
         trainer.accelerator.wait_for_everyone()
     else:
         if args.push_to_hub:
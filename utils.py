@@ -1,6 +1,10 @@
-import random
+import re
 import torch
 import os
+import queue
+import threading
+import itertools
+import numpy as np
 import datasets
 from typing import List, Dict, Any
 from functools import partial
@@ -15,7 +19,6 @@ from transformers import (
 )
 from torch.utils.data import IterableDataset
 from datasets import load_dataset
-from tqdm import tqdm
 import warnings
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 from peft.tuners.lora import LoraLayer
@@ -39,83 +42,108 @@ from constant import METEORA_TASKS
 
 IGNORE_INDEX = -100
 
-def tokenize_dataset(input: Dict[str, str], tokenizer, max_length=None, task_index=None) -> Dict[str, Any]:
-    # This special index is used to ignore certain tokens during loss calculation.
-    input_ids, attention_mask, labels, gate_labels = [], [], [], []
-    keys = ["prompt", "response"]
-    for key in keys:
-        text = input[key]
-        msg_tokenized = tokenizer(
-            text,
-            truncation=False, # truncate later
-            add_special_tokens=False, # since we already added the chatml style special tokens manually
-        )
-        input_ids += msg_tokenized['input_ids']
-        attention_mask += msg_tokenized['attention_mask']
-        # labels += [IGNORE_INDEX] * len(msg_tokenized['input_ids']) if key == "prompt" else msg_tokenized['input_ids']
-        # gate_labels += [IGNORE_INDEX] * len(msg_tokenized['input_ids']) if key == "prompt" else [data_index] * len(msg_tokenized['input_ids'])        
-        labels += msg_tokenized['input_ids'] if key == "prompt" else msg_tokenized['input_ids']
-        gate_labels += [task_index] * len(msg_tokenized['input_ids']) if key == "prompt" else [task_index] * len(msg_tokenized['input_ids'])        
-    final_labels = [labels, gate_labels]
-    # truncate here
-    final_labels[0] = final_labels[0][:max_length]
-    final_labels[1] = final_labels[1][:max_length]
+# fixed schema of the tokenized datasets, so every tokenized shard has identical arrow types and
+# concatenate_datasets only has to concatenate the tables instead of casting and copying them
+TOKENIZED_FEATURES = datasets.Features({
+    "input_ids": datasets.Sequence(datasets.Value("int64")),
+    "labels": datasets.Sequence(datasets.Value("int64")),
+    # task indices and IGNORE_INDEX fit in int16, the collator stacks them with the labels as torch.long
+    "gate_labels": datasets.Sequence(datasets.Value("int16")),
+})
+
+def tokenize_batch(examples: Dict[str, List[str]], tokenizer, max_length=None, task_index=None) -> Dict[str, List[Any]]:
+    # tokenize all prompts and all responses of the batch at once, so the rust tokenizer is called twice per batch instead of twice per sample
+    # identical prompts in the batch are tokenized only once and then mapped back to their rows
+    prompt_positions = {prompt: i for i, prompt in enumerate(dict.fromkeys(examples["prompt"]))}
+    unique_prompts_tokenized = tokenizer(
+        list(prompt_positions),
+        truncation=False, # truncate later
+        add_special_tokens=False, # since we already added the chatml style special tokens manually
+        return_attention_mask=False,
+    )
+    prompts_input_ids = [unique_prompts_tokenized['input_ids'][prompt_positions[prompt]] for prompt in examples["prompt"]]
+    responses = tokenizer(
+        examples["response"],
+        truncation=False,
+        add_special_tokens=False,
+        return_attention_mask=False,
+    )
+    # rows tagged with a "data_index" column carry their own task index, otherwise the whole dataset shares task_index
+    task_indices = examples["data_index"] if "data_index" in examples else [task_index] * len(examples["prompt"])
+    # the attention mask is all ones before padding, it is rebuilt from the sample length in the collator
+    batch_input_ids, batch_labels, batch_gate_labels = [], [], []
+    for prompt_ids, response_ids, row_task_index in zip(prompts_input_ids, responses['input_ids'], task_indices):
+        input_ids = prompt_ids + response_ids
+        # labels = [IGNORE_INDEX] * len(prompt_ids) + response_ids
+        # gate_labels = [IGNORE_INDEX] * len(prompt_ids) + [task_index] * len(response_ids)
+        labels = input_ids
+        gate_labels = [row_task_index] * len(input_ids)
+        # truncate here
+        batch_input_ids.append(input_ids[:max_length])
+        batch_labels.append(labels[:max_length])
+        batch_gate_labels.append(gate_labels[:max_length])
     return {
-        "input_ids": input_ids[:max_length],
-        "attention_mask": attention_mask[:max_length],
-        "labels": final_labels
+        "input_ids": batch_input_ids,
+        "labels": batch_labels,
+        "gate_labels": batch_gate_labels,
     }
 
-def collate_dataset(samples: List[Dict[str, Any]], tokenizer) -> Dict[str, Any]:
-    """collate the dataset to a batch
+def collate_dataset(samples: List[Dict[str, Any]], tokenizer, pad_to_multiple_of=8) -> Dict[str, Any]:
+    """collate the dataset to a batch, see `collate_dataset_fast`
+    """
+    return collate_dataset_fast(samples, tokenizer.pad_token_id, pad_to_multiple_of=pad_to_multiple_of)
+
+def collate_dataset_fast(samples: List[Dict[str, Any]], pad_id: int, pad_to_multiple_of=8) -> Dict[str, Any]:
+    """collate the dataset to a batch, bind `pad_id` with `functools.partial` to keep the tokenizer out of the collator
 
     Args:
         samples (List[Dict[str, Any]]): [{
             "input_ids": ...,
-            "attention_mask": ...,
-            "labels": ...
+            "labels": ...,
+            "gate_labels": ...
         }]
+        pad_id (int): the <PAD> token id, i.e. `tokenizer.pad_token_id`
+        pad_to_multiple_of (int): round the padded length up to a multiple of this value so bf16/fp16 GEMMs
+            stay on the tensor-core path. The few extra tokens are masked out. Set to 1 to pad to the longest sample.
     """
     max_len = max([len(s['input_ids']) for s in samples])
     max_len_clip = max_len
     if max_len > 4096:
         warnings.warn(f"The max length of a single sample is {max_len}, which exceeds the maximum sequence length of 4096.")
         max_len_clip = 4096
-
-    # print([len(s['input_ids']) for s in samples])
-    # print(max_len)
-    batch_samples = {
-        "input_ids": [],
-        "attention_mask": [],
-        "labels": []
-    }
-    
-    pad_elems = {
-        "input_ids": tokenizer.pad_token_id, # append with <PAD> token to align
-        "attention_mask": 0, # append with 0 to ignore the padding tokens
-        "labels": IGNORE_INDEX # append with -100 to ignore them during loss calculation
+    # at most pad_to_multiple_of - 1 extra padding tokens per sample, which is negligible compared with the aligned kernels
+    max_len = ((max_len + pad_to_multiple_of - 1) // pad_to_multiple_of) * pad_to_multiple_of
+
+    batch_size = len(samples)
+    # preallocate the padded batch and copy each sample into its row, instead of padding python lists and converting them afterwards
+    input_ids = torch.full((batch_size, max_len), pad_id, dtype=torch.long) # <PAD> token to align
+    attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long) # 0 to ignore the padding tokens
+    labels = torch.full((batch_size, 2, max_len), IGNORE_INDEX, dtype=torch.long) # -100 to ignore them during loss calculation
+    # the fields are known, so look each of them up once per sample instead of iterating and comparing the keys
+    for i, sample in enumerate(samples):
+        ids, lab, glab = sample['input_ids'], sample['labels'], sample['gate_labels']
+        n = len(ids)
+        input_ids[i, :n] = torch.as_tensor(ids)
+        attention_mask[i, :n] = 1
+        labels[i, 0, :n] = torch.as_tensor(lab)
+        labels[i, 1, :n] = torch.as_tensor(glab)
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "labels": labels
     }
-    for sample in samples:
-        # if max_len > max_len_clip:
-        #     sample = sample[:]
-        # print(max_len,len(sample['input_ids']))
-        pad_len = max_len - len(sample['input_ids'])
-        # padding each sample to align with the longest one
-        for k in sample:
-            if k == "labels":
-                batch_samples[k].append([sample[k][0] + [pad_elems[k]] * pad_len, sample[k][1] + [pad_elems[k]] * pad_len])
-            else:
-                batch_samples[k].append(
-                    sample[k] + [pad_elems[k]] * pad_len
-                )
-            # print(len(batch_samples['input_ids'][k]), len(batch_samples['attention_mask'][k]), len(batch_samples['labels'][k][0]), len(batch_samples['labels'][k][1]))
-    # the dtype should be torch.long or torch.int64, but it is not necessary since the default dtype for a int list is just int64
-    # print(len(batch_samples['input_ids'][0]), len(batch_samples['input_ids'][1]), len(batch_samples['labels'][0][1]), len(batch_samples['labels'][1][1]))
-    # print(max_len)
-    batch = {k: torch.tensor(v, dtype=torch.long)  for k,v in batch_samples.items()} 
-    # print(batch["input_ids"].size(), batch["labels"].size())
-    # print(batch["attention_mask"])
-    return batch
+
+def save_deepspeed_peft_model(trainer, output_dir):
+    accelerator = trainer.accelerator
+    deepspeed_plugin = accelerator.state.deepspeed_plugin
+    # with zero-3 the sharded weights are gathered collectively, so every rank has to join, otherwise
+    # only the main process materializes the state dict since it is the only one writing it
+    state_dict = None
+    if (deepspeed_plugin is not None and deepspeed_plugin.zero_stage == 3) or accelerator.is_main_process:
+        state_dict = accelerator.get_state_dict(trainer.deepspeed)
+    if accelerator.is_main_process:
+        unwrapped_model = accelerator.unwrap_model(trainer.deepspeed)
+        unwrapped_model.save_pretrained(output_dir, state_dict=state_dict)
 
 class SaveDeepSpeedPeftModelCallback(TrainerCallback):
     def __init__(self, trainer, save_steps=500):
@@ -131,12 +159,7 @@ class SaveDeepSpeedPeftModelCallback(TrainerCallback):
     ):
         if (state.global_step + 1) % self.save_steps == 0:
             self.trainer.accelerator.wait_for_everyone()
-            state_dict = self.trainer.accelerator.get_state_dict(self.trainer.deepspeed)
-            unwrapped_model = self.trainer.accelerator.unwrap_model(
-                self.trainer.deepspeed
-            )
-            if self.trainer.accelerator.is_main_process:
-                unwrapped_model.save_pretrained(args.output_dir, state_dict=state_dict)
+            save_deepspeed_peft_model(self.trainer, args.output_dir)
             self.trainer.accelerator.wait_for_everyone()
         return control
 
@@ -153,8 +176,13 @@ class ConstantLengthDataset(IterableDataset):
             chars_per_token (int): Number of characters per token used to estimate number of tokens in text buffer.
             shuffle (bool): If true, the samples in each buffer are suffled. Default is `True`.
             add_eos_token (bool): If true, each buffer is delimited with eos token. Default is `True`.
+            num_prefetch_buffers (int): Number of buffers prepared ahead by a background thread while the
+                trainer consumes the current one. `0` fills the buffers synchronously. Default is `2`.
     """
 
+    # number of examples pulled from the dataset iterator at once while filling a buffer
+    fetch_size = 64
+
     def __init__(
         self,
         tokenizer,
@@ -166,6 +194,7 @@ class ConstantLengthDataset(IterableDataset):
         content_field="content",
         shuffle=True,
         add_eos_token=True,
+        num_prefetch_buffers=2,
     ):
         self.tokenizer = tokenizer
         self.concat_token_id = tokenizer.eos_token_id
@@ -177,42 +206,84 @@ class ConstantLengthDataset(IterableDataset):
         self.content_field = content_field
         self.shuffle = shuffle
         self.add_eos_token = add_eos_token
+        self.num_prefetch_buffers = num_prefetch_buffers
 
-    def __iter__(self):
+    def _iter_buffers(self):
         iterator = iter(self.dataset)
         more_examples = True
         while more_examples:
             buffer, buffer_len = [], 0
-            while True:
-                if buffer_len >= self.max_buffer_size:
-                    break
-                try:
-                    buffer.append(next(iterator)[self.content_field])
-                    buffer_len += len(buffer[-1])
-                except StopIteration:
+            while buffer_len < self.max_buffer_size:
+                # pull the texts in chunks and update the char budget once per chunk instead of once per example
+                texts = [example[self.content_field] for example in itertools.islice(iterator, self.fetch_size)]
+                buffer.extend(texts)
+                buffer_len += sum(map(len, texts))
+                if len(texts) < self.fetch_size:
                     if self.infinite:
                         iterator = iter(self.dataset)
                     else:
                         more_examples = False
                         break
             tokenized_inputs = self.tokenizer(buffer, truncation=False)["input_ids"]
-            all_token_ids = []
-            for tokenized_input in tokenized_inputs:
-                if self.add_eos_token:
-                    tokenized_input = tokenized_input + [self.concat_token_id]
-                all_token_ids.extend(tokenized_input)
-            examples = []
-            for i in range(0, len(all_token_ids), self.seq_length):
-                input_ids = all_token_ids[i : i + self.seq_length]
-                if len(input_ids) == self.seq_length:
-                    examples.append(input_ids)
-            if self.shuffle:
-                random.shuffle(examples)
-            for example in examples:
+            if self.add_eos_token:
+                tokenized_inputs = [tokenized_input + [self.concat_token_id] for tokenized_input in tokenized_inputs]
+            # flatten in C instead of extending a python list, then share the memory with torch
+            all_token_ids = np.fromiter(itertools.chain.from_iterable(tokenized_inputs), dtype=np.int64)
+            all_token_ids = torch.from_numpy(all_token_ids)
+            # drop the incomplete tail and view the buffer as rows of seq_length tokens
+            num_examples = len(all_token_ids) // self.seq_length
+            examples = all_token_ids[: num_examples * self.seq_length].view(num_examples, self.seq_length)
+            # shuffle the row order instead of gathering the rows, so the yielded examples stay views into this buffer
+            order = torch.randperm(num_examples).tolist() if self.shuffle else range(num_examples)
+            yield examples, order
+
+    def _prefetch_buffers(self):
+        # fill the next buffers in a background thread, the rust tokenizer releases the GIL while tokenizing
+        buffers = queue.Queue(maxsize=self.num_prefetch_buffers)
+        stop = threading.Event()
+        end_of_buffers = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffers.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for buffer in self._iter_buffers():
+                    if not put(buffer):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(end_of_buffers)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                buffer = buffers.get()
+                if buffer is end_of_buffers:
+                    break
+                if isinstance(buffer, Exception):
+                    raise buffer
+                yield buffer
+        finally:
+            stop.set()
+
+    def __iter__(self):
+        buffers = self._prefetch_buffers() if self.num_prefetch_buffers > 0 else self._iter_buffers()
+        for examples, order in buffers:
+            for i in order:
+                example = examples[i]
                 self.current_size += 1
                 yield {
-                    "input_ids": torch.LongTensor(example),
-                    "labels": torch.LongTensor(example),
+                    "input_ids": example,
+                    "labels": example,
                 }
 
 
@@ -220,10 +291,11 @@ def chars_token_ratio(dataset, tokenizer, data_column, nb_examples=400):
     """
     Estimate the average number of characters per token in the dataset.
     """
-    total_characters, total_tokens = 0, 0
-    for _, example in tqdm(zip(range(nb_examples), iter(dataset)), total=nb_examples):
-        total_characters += len(example[data_column])
-        total_tokens += len(tokenizer(example[data_column]).tokens())
+    texts = [example[data_column] for _, example in zip(range(nb_examples), iter(dataset))]
+    # only the token counts are needed, so tokenize all texts in one call and skip building token strings
+    tokenized_texts = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    total_characters = sum(map(len, texts))
+    total_tokens = sum(len(input_ids) for input_ids in tokenized_texts)
 
     return total_characters / total_tokens
 
@@ -233,11 +305,15 @@ def tokenize_datasets(dataset, tokenizer, max_length, dataset_type, data_index):
     print(dataset.map, task_id)
     
     dataset_tokenized = dataset.map(
-        partial(tokenize_dataset, tokenizer=tokenizer, max_length=max_length, task_index=task_id),
-        batched=False,
-        num_proc=4,
-        # num_proc=os.cpu_count(),    # multi-threaded with all cpu cores
-        # remove_columns=dataset["dataset_type"].column_names  # don't need this anymore, we have tokens from here on
+        partial(tokenize_batch, tokenizer=tokenizer, max_length=max_length, task_index=task_id),
+        batched=True,
+        batch_size=1000,
+        num_proc=os.cpu_count(),    # multi-threaded with all cpu cores
+        load_from_cache_file=True,  # reuse the arrow cache of a previous run instead of re-tokenizing
+        writer_batch_size=10_000,
+        remove_columns=dataset.column_names,  # don't need this anymore, we have tokens from here on
+        desc=f"tokenize-{dataset_type}-{task_id if task_id is not None else 'mixed'}",
+        features=TOKENIZED_FEATURES,
     )
     print(dataset_tokenized)
     return dataset_tokenized
@@ -341,39 +417,38 @@ def load_meteora_model(weight_path, model_path, tasks_datasets_prefix, lora_path
 
 def create_gsm8k_vggio_sqlctx(data_path_prefix, tokenizer, max_length):
 
-    gsm8k_data_files = {"train": data_path_prefix+"gsm8k-train.jsonl", "test": data_path_prefix+"gsm8k-test.jsonl"}
-    viggo_data_files = {"train": data_path_prefix+"viggo-train.jsonl", "test": data_path_prefix+"viggo-test.jsonl"}
+    # parse all json files in a single load, each file becomes its own split
+    data_files = {
+        "gsm8k_train": data_path_prefix+"gsm8k-train.jsonl",
+        "gsm8k_test": data_path_prefix+"gsm8k-test.jsonl",
+        "viggo_train": data_path_prefix+"viggo-train.jsonl",
+        "viggo_test": data_path_prefix+"viggo-test.jsonl",
+        "sqlctx_train": data_path_prefix+"sqlctx-train.jsonl",
+    }
+    raw_dataset = datasets.load_dataset('json', data_files=data_files)
+    sqlctx_dataset = raw_dataset['sqlctx_train'].train_test_split(test_size=0.1, seed=42)
 
-    gsm8k_dataset = datasets.load_dataset('json', data_files=gsm8k_data_files)
-    
-    data_index = 0
-    
-    gsm8k_train_dataset = tokenize_datasets(gsm8k_dataset['train'], tokenizer, max_length, "train", data_index)
-    gsm8k_test_dataset = tokenize_datasets(gsm8k_dataset['test'], tokenizer, max_length, "test", data_index)
-    
-    data_index += 1
-    
-    viggo_dataset = datasets.load_dataset('json', data_files=viggo_data_files)
-    viggo_train_dataset = tokenize_datasets(viggo_dataset['train'], tokenizer, max_length, "train", data_index)
-    viggo_test_dataset = tokenize_datasets(viggo_dataset['test'], tokenizer, max_length, "test", data_index)
-    
-    data_index += 1
-    
-    sqlctx_raw_dataset = datasets.load_dataset('json', data_files=data_path_prefix+"sqlctx-train.jsonl")
-    sqlctx_dataset = sqlctx_raw_dataset['train'].train_test_split(test_size=0.1)
+    dataset_splits = {
+        "gsm8k": (raw_dataset['gsm8k_train'], raw_dataset['gsm8k_test']),
+        "viggo": (raw_dataset['viggo_train'], raw_dataset['viggo_test']),
+        "sqlctx": (sqlctx_dataset['train'], sqlctx_dataset['test']),
+    }
+    # tag every row with its dataset index, so the merged splits are tokenized once with per-row gate labels
+    for data_index, name in enumerate(["gsm8k", "viggo", "sqlctx"]):
+        train_dataset, test_dataset = dataset_splits[name]
+        dataset_splits[name] = (
+            train_dataset.add_column("data_index", [data_index] * len(train_dataset)),
+            test_dataset.add_column("data_index", [data_index] * len(test_dataset)),
+        )
 
-    sqlctx_train_dataset = tokenize_datasets(sqlctx_dataset['train'], tokenizer, max_length, "train", data_index)
-    sqlctx_test_dataset = tokenize_datasets(sqlctx_dataset['test'], tokenizer, max_length, "test", data_index)
-    
-    merged_train_dataset = datasets.concatenate_datasets([gsm8k_train_dataset, sqlctx_train_dataset, viggo_train_dataset])
-    merged_test_dataset = datasets.concatenate_datasets([gsm8k_test_dataset, sqlctx_test_dataset, viggo_test_dataset]) 
-    # merged_train_dataset = datasets.concatenate_datasets([gsm8k_dataset['train'], sqlctx_dataset['train'], viggo_dataset['train']])
-    # merged_test_dataset = datasets.concatenate_datasets([gsm8k_dataset['test'], sqlctx_dataset['test'], viggo_dataset['test']])
+    merge_order = ["gsm8k", "sqlctx", "viggo"]
+    merged_train_dataset = datasets.concatenate_datasets([dataset_splits[name][0] for name in merge_order])
+    merged_test_dataset = datasets.concatenate_datasets([dataset_splits[name][1] for name in merge_order])
+    merged_train_dataset = tokenize_datasets(merged_train_dataset, tokenizer, max_length, "train", None)
+    merged_test_dataset = tokenize_datasets(merged_test_dataset, tokenizer, max_length, "test", None)
 
     print("dataset is loaded, train:", merged_train_dataset, "test:", merged_test_dataset)
-    # merged_train_dataset = tokenize_datasets(merged_train_dataset, tokenizer, max_length, "train")
-    # merged_test_dataset = tokenize_datasets(merged_test_dataset, tokenizer, max_length, "test")
-    
+
     return merged_train_dataset, merged_test_dataset
 
 def create_datasets(tokenizer, dataset_name, args):
@@ -474,17 +549,31 @@ def create_and_prepare_model(args):
     return model, peft_config
 
 
+_CASTING_NAME_PATTERN = re.compile(r"(norm)|(lm_head|embed_tokens|wte|wpe)")
+
 def peft_module_casting_to_bf16(model, args):
-    for name, module in model.named_modules():
-        if isinstance(module, LoraLayer):
-            if args.bf16:
-                module = module.to(torch.bfloat16)
-        if "norm" in name:
-            module = module.to(torch.float32)
-        if any(x in name for x in ["lm_head", "embed_tokens", "wte", "wpe"]):
-            if hasattr(module, "weight"):
-                if args.bf16 and module.weight.dtype == torch.float32:
-                    module = module.to(torch.bfloat16)
+    # single pass over the parameters: norms in fp32 (if needed), lora layers and embeddings/lm_head in bf16
+    # on Ampere+ bf16 norms are accurate enough, keep them in bf16 to avoid the extra up/down casts unless fp32 is forced
+    cast_norm_to_fp32 = args.force_fp32_norm or not (
+        args.bf16 and torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+    )
+    lora_param_ids = set()
+    if args.bf16:
+        for module in model.modules():
+            if isinstance(module, LoraLayer):
+                lora_param_ids.update(id(p) for p in module.parameters())
+    for name, param in model.named_parameters():
+        match = _CASTING_NAME_PATTERN.search(name)
+        # quantized (int8/packed 4bit) base weights must keep their dtype, like `module.to` only casts floating point tensors
+        if not param.is_floating_point():
+            continue
+        if match is not None and match.group(1):
+            if cast_norm_to_fp32:
+                param.data = param.data.to(torch.float32)
+        elif id(param) in lora_param_ids:
+            param.data = param.data.to(torch.bfloat16)
+        elif match is not None and args.bf16 and param.dtype == torch.float32:
+            param.data = param.data.to(torch.bfloat16)
 
 def load_peft_model(base_model_path, adapter_path):
     tokenizer = AutoTokenizer.from_pretrained(base_model_path)